@@ -4,13 +4,12 @@ methods to perform POMDP tasks, like finding the optimal action and updating
 the belief.
 
 author: mbforbes
-
-TODO(mbforbes): Check model after construction to provide sanity check for
-                specified pomdp environment (e.g. observation and transition
-                probabilities sum to 1.0)
 """
 
 # builtins
+import itertools
+import os
+import threading
 import xml.etree.ElementTree as ET
 
 # 3rd party
@@ -28,14 +27,24 @@ class POMDP:
         belief      numpy array
     """
 
-    def __init__(self, pomdp_env_filename, pomdp_policy_filename, prior):
+    def __init__(self, pomdp_env_filename, pomdp_policy_filename, prior,
+                 reloadable=False):
         """
         pomdp_env_filename    string
         pomdp_policy_filename string
         prior                 numpy array
+        reloadable            bool, whether to wrap the policy in a
+                              ReloadablePolicy so it can be swapped
+                              without rebuilding this object
         """
         self.pomdpenv = POMDPEnvironment(pomdp_env_filename)
-        self.pomdppolicy = POMDPPolicy(pomdp_policy_filename)
+        n_states = len(self.pomdpenv.states)
+        if reloadable:
+            self.pomdppolicy = ReloadablePolicy(
+                pomdp_policy_filename, n_states)
+        else:
+            self.pomdppolicy = POMDPPolicy(pomdp_policy_filename)
+            self.pomdppolicy.check(n_states)
         self.belief = prior
 
     def get_action_str(self, action_num):
@@ -99,10 +108,14 @@ class POMDP:
 
 
 class POMDPEnvironment:
-    def __init__(self, filename):
+    def __init__(self, filename, check=True, normalize=False):
         """
         Parses .pomdp file and loads info into this object's fields.
 
+        If check, runs check_model() and raises listing every T and Z
+        row that doesn't sum to 1.0. If normalize, such rows are
+        rescaled in place instead (rows with no mass still raise).
+
         Attributes:
             discount
             values
@@ -112,6 +125,18 @@ class POMDPEnvironment:
             T
             Z
             R
+            version     int, bumped on every edit made through the
+                        set_* methods so callers holding derived data
+                        can tell it is stale
+            unreachable_observations
+                        numpy bool array, [action, obs] is True if obs
+                        has zero probability from every next state
+                        after action; set by check_model() and kept
+                        up to date by the set_observation* methods
+
+        Edit T and Z through the set_* methods rather than the dicts
+        directly; the per-action matrices below are cached and only
+        the set_* methods keep them in sync.
         """
         f = open(filename, 'r')
         self.contents = [
@@ -151,6 +176,24 @@ class POMDPEnvironment:
         # cleanup
         f.close()
 
+        # per-action matrices derived from T, Z, and R; built lazily
+        self.version = 0
+        self.__T_array = None
+        self.__Z_array = None
+        self.__reward_cache = {}
+        self.__R_array = None
+        self.unreachable_observations = None
+
+        if check:
+            bad_rows = self.check_model(normalize=normalize)
+            if normalize and bad_rows:
+                # Whatever normalizing couldn't fix.
+                bad_rows = self.check_model()
+            if bad_rows:
+                raise Exception(
+                    "Bad rows (table, action, state, sum): " +
+                    ", ".join(str(row) for row in bad_rows))
+
     def __get_discount(self, i):
         line = self.contents[i]
         self.discount = float(line.split()[1])
@@ -433,22 +476,296 @@ class POMDPEnvironment:
         observation_num int
         return          numpy array
         """
-        b_new_nonnormalized = []
-        for s_prime in range(len(self.states)):
-            p_o_prime = self.Z[(action_num, s_prime, observation_num)]
-            summation = 0.0
-            for s in range(len(self.states)):
-                p_s_prime = self.T[(action_num, s, s_prime)]
-                b_s = float(prev_belief[s])
-                summation = summation + p_s_prime * b_s
-            b_new_nonnormalized.append(p_o_prime * summation)
-
-        # normalize
-        b_new = []
-        total = sum(b_new_nonnormalized)
-        for b_s in b_new_nonnormalized:
-            b_new.append([b_s/total])
-        return np.array(b_new)
+        T = self.get_transition_matrix(action_num)
+        Z = self.get_observation_matrix(action_num)
+        b = np.asarray(prev_belief, dtype=float).reshape(-1)
+        b_new = Z[:, observation_num] * T.T.dot(b)
+        total = b_new.sum()
+        if total == 0.0:
+            raise Exception(
+                "Observation %s is impossible after action %s from this "
+                "belief" % (self.observations[observation_num],
+                            self.actions[action_num]))
+        return (b_new / total).reshape((-1, 1))
+
+    def expected_reward(self, belief, action_num):
+        """
+        Expected immediate reward of taking action_num in belief.
+
+        belief     numpy array
+        action_num int
+        return     float
+        """
+        b = np.asarray(belief, dtype=float).reshape(-1)
+        return float(self.get_reward_vector(action_num).dot(b))
+
+    def get_transition_matrix(self, action_num):
+        """
+        Returns T for action_num as an S x S numpy array indexed
+        [start-state, next-state]. Cached; don't modify it.
+        """
+        return self.__transition_array()[action_num]
+
+    def get_observation_matrix(self, action_num):
+        """
+        Returns Z for action_num as an S x O numpy array indexed
+        [next-state, obs]. Entries given for action * are used where
+        action_num has none. Cached; don't modify it.
+        """
+        return self.__observation_array()[action_num]
+
+    def __transition_array(self):
+        """
+        Returns the cached A x S x S stack of transition matrices.
+        """
+        if self.__T_array is None:
+            n = len(self.states)
+            self.__T_array = self.__to_array(
+                self.T, (len(self.actions), n, n))
+        return self.__T_array
+
+    def __observation_array(self):
+        """
+        Returns the cached A x S x O stack of observation matrices.
+        """
+        if self.__Z_array is None:
+            shape = (len(self.states), len(self.observations))
+            wildcard = dict(
+                (key[1:], p) for key, p in self.Z.items() if key[0] is None)
+            specific = dict(
+                (key, p) for key, p in self.Z.items() if key[0] is not None)
+            Z = np.empty((len(self.actions),) + shape)
+            Z[:] = self.__to_array(wildcard, shape)
+            self.__Z_array = self.__to_array(specific, Z.shape, Z)
+        return self.__Z_array
+
+    def check_model(self, tol=1e-6, normalize=False):
+        """
+        Checks that every T and Z row is a probability distribution:
+        finite, non-negative, and summing to 1.0 (within tol). Uses a
+        few reductions over the stacked per-action matrices, and sets
+        self.unreachable_observations.
+
+        If normalize, rescales each offending row that is finite,
+        non-negative, and has some mass so it sums to 1.0, in one pass
+        that bumps version once. Rows that came from * observation
+        entries get an action-specific override rather than editing
+        the * entry.
+
+        tol       float
+        normalize bool
+        return    list of (table, action, state, sum) tuples, one per
+                  offending row, where table is 'T' or 'Z' and sum is
+                  the row's sum before any normalization
+        """
+        bad_rows = []
+        changed = False
+        for name, M, table in (('T', self.__transition_array(), self.T),
+                               ('Z', self.__observation_array(), self.Z)):
+            sums = M.sum(axis=2)
+            with np.errstate(invalid='ignore'):
+                # Written so NaN sums count as bad.
+                off = ~(np.abs(sums - 1.0) <= tol)
+                finite = np.isfinite(M).all(axis=2)
+                invalid = (M < 0.0).any(axis=2) | ~finite
+                fix = off & ~invalid & (sums > 0.0)
+            for a, s in np.argwhere(off | invalid):
+                bad_rows.append((name, int(a), int(s), float(sums[a, s])))
+            if not normalize or not fix.any():
+                continue
+            # Rescale the cached stack in place, then copy the fixed
+            # rows back into the dict.
+            M[fix] /= sums[fix][:, np.newaxis]
+            n = M.shape[2]
+            for a, s in np.argwhere(fix):
+                a, s = int(a), int(s)
+                table.update(((a, s, j), float(M[a, s, j]))
+                             for j in range(n))
+            for a in np.unique(np.nonzero(fix)[0]):
+                self.__reward_cache.pop(a, None)
+            changed = True
+
+        if changed:
+            self.version += 1
+        self.unreachable_observations = (
+            self.__observation_array().sum(axis=1) == 0.0)
+        return bad_rows
+
+    def get_reward_vector(self, action_num):
+        """
+        Returns the expected immediate reward of action_num from each
+        start state, i.e. R averaged over next states and observations,
+        as a length S numpy array. Cached; don't modify it.
+        """
+        if action_num not in self.__reward_cache:
+            if self.__R_array is None:
+                n = len(self.states)
+                shape = (n, n, len(self.observations))
+                wildcard = dict(
+                    (key[1:], r) for key, r in self.R.items()
+                    if key[0] is None)
+                specific = dict(
+                    (key, r) for key, r in self.R.items()
+                    if key[0] is not None)
+                R = np.empty((len(self.actions),) + shape)
+                R[:] = self.__to_array(wildcard, shape)
+                self.__R_array = self.__to_array(specific, R.shape, R)
+            T = self.get_transition_matrix(action_num)
+            Z = self.get_observation_matrix(action_num)
+            self.__reward_cache[action_num] = np.einsum(
+                'ij,jo,ijo->i', T, Z, self.__R_array[action_num])
+        return self.__reward_cache[action_num]
+
+    def set_transition(self, action_num, start_state, next_state, prob,
+                       normalize=False):
+        """
+        Sets T(start_state, action_num, next_state) to prob. If
+        normalize, rescales the rest of the start_state row so it sums
+        to 1.0 with prob held fixed.
+        """
+        self.__check_index(action_num, len(self.actions), 'action')
+        self.__check_index(start_state, len(self.states), 'state')
+        self.__check_index(next_state, len(self.states), 'state')
+        prob = self.__check_prob(prob)
+        row = self.__transition_row(action_num, start_state)
+        row[next_state] = prob
+        if normalize:
+            row = self.__normalized(row, (action_num, start_state),
+                                    next_state)
+        self.__write_transition_row(action_num, start_state, row)
+
+    def set_transition_row(self, action_num, start_state, probs,
+                           normalize=False):
+        """
+        Sets T(start_state, action_num, *) to probs, a sequence with one
+        entry per state. If normalize, rescales it to sum to 1.0.
+        """
+        self.__check_index(action_num, len(self.actions), 'action')
+        self.__check_index(start_state, len(self.states), 'state')
+        assert len(probs) == len(self.states)
+        row = self.__check_row(probs)
+        if normalize:
+            row = self.__normalized(row, (action_num, start_state))
+        self.__write_transition_row(action_num, start_state, row)
+
+    def set_observation(self, action_num, next_state, obs, prob,
+                        normalize=False):
+        """
+        Sets Z(action_num, next_state, obs) to prob. If normalize,
+        rescales the rest of the next_state row so it sums to 1.0 with
+        prob held fixed. action_num None edits the * entries; otherwise
+        the row is written as action-specific entries, starting from
+        the * entries where action_num has none.
+        """
+        if action_num is not None:
+            self.__check_index(action_num, len(self.actions), 'action')
+        self.__check_index(next_state, len(self.states), 'state')
+        self.__check_index(obs, len(self.observations), 'observation')
+        prob = self.__check_prob(prob)
+        row = self.__observation_row(action_num, next_state)
+        row[obs] = prob
+        if normalize:
+            row = self.__normalized(row, (action_num, next_state), obs)
+        self.__write_observation_row(action_num, next_state, row)
+
+    def set_observation_row(self, action_num, next_state, probs,
+                            normalize=False):
+        """
+        Sets Z(action_num, next_state, *) to probs, a sequence with one
+        entry per observation. If normalize, rescales it to sum to 1.0.
+        action_num None edits the * entries.
+        """
+        if action_num is not None:
+            self.__check_index(action_num, len(self.actions), 'action')
+        self.__check_index(next_state, len(self.states), 'state')
+        assert len(probs) == len(self.observations)
+        row = self.__check_row(probs)
+        if normalize:
+            row = self.__normalized(row, (action_num, next_state))
+        self.__write_observation_row(action_num, next_state, row)
+
+    def __to_array(self, table, shape, out=None):
+        """
+        Scatters a dict keyed by index tuples into a numpy array of the
+        given shape (zeros where table has no entry, unless out is
+        given, in which case out is filled in and returned).
+        """
+        if out is None:
+            out = np.zeros(shape)
+        if table:
+            index = np.array(list(table.keys()), dtype=int)
+            out[tuple(index.T)] = list(table.values())
+        return out
+
+    def __transition_row(self, a, s):
+        return [self.T.get((a, s, j), 0.0) for j in range(len(self.states))]
+
+    def __observation_row(self, a, s):
+        return [self.Z.get((a, s, j), self.Z.get((None, s, j), 0.0))
+                for j in range(len(self.observations))]
+
+    def __check_index(self, value, n, what):
+        if not (isinstance(value, (int, long, np.integer)) and
+                0 <= value < n):
+            raise Exception("Bad %s index: %r" % (what, value))
+
+    def __check_prob(self, prob):
+        prob = float(prob)
+        if not 0.0 <= prob <= 1.0:
+            raise Exception("Probability must be in [0, 1]: %r" % (prob,))
+        return prob
+
+    def __check_row(self, probs):
+        row = [float(p) for p in probs]
+        if not all(0.0 <= p < float('inf') for p in row):
+            raise Exception("Row entries must be finite and non-negative: " +
+                            str(row))
+        return row
+
+    def __normalized(self, row, where, fixed=None):
+        """
+        Returns row rescaled to sum to 1.0. If fixed is given, that
+        entry is left alone and the others share what remains (all
+        zero if fixed is 1.0). Raises without touching anything if the
+        row has no mass to rescale.
+        """
+        target = 1.0 if fixed is None else 1.0 - row[fixed]
+        if target == 0.0:
+            return [p if j == fixed else 0.0 for j, p in enumerate(row)]
+        total = sum(p for j, p in enumerate(row) if j != fixed)
+        if total <= 0.0:
+            raise Exception("Cannot normalize row with no mass: " +
+                            str(where))
+        return [p if j == fixed else p * target / total
+                for j, p in enumerate(row)]
+
+    def __write_transition_row(self, a, s, row):
+        for j, p in enumerate(row):
+            self.T[(a, s, j)] = p
+        # Patch the cached matrix row in place rather than rebuilding it.
+        if self.__T_array is not None:
+            self.__T_array[a, s, :] = row
+        self.__reward_cache.pop(a, None)
+        self.version += 1
+
+    def __write_observation_row(self, a, s, row):
+        for j, p in enumerate(row):
+            self.Z[(a, s, j)] = p
+        if a is None:
+            # * entries feed every action's matrix.
+            self.__Z_array = None
+            self.__reward_cache.clear()
+            affected = range(len(self.actions))
+        else:
+            if self.__Z_array is not None:
+                self.__Z_array[a, s, :] = row
+            self.__reward_cache.pop(a, None)
+            affected = [a]
+        if self.unreachable_observations is not None:
+            for action in affected:
+                self.unreachable_observations[action] = (
+                    self.get_observation_matrix(action).sum(axis=0) == 0.0)
+        self.version += 1
 
     def print_summary(self):
         print "discount:", self.discount
@@ -464,6 +781,184 @@ class POMDPEnvironment:
         print "R:", self.R
 
 
+class StateVariable:
+    """
+    One factor of a FactoredPOMDPEnvironment. Each variable evolves and
+    is observed independently of the others given the action.
+
+    Attributes:
+        name           string
+        values         list of strings, the values this variable takes
+        observations   list of strings, what can be observed about it
+        T              numpy array, T[a, s, s'] for this variable
+        Z              numpy array, Z[a, s', o] for this variable
+        R              numpy array, R[a, s], this variable's additive
+                       share of the immediate reward
+    """
+
+    def __init__(self, name, values, observations, T, Z, R=None):
+        """
+        name         string
+        values       list of strings
+        observations list of strings
+        T            array-like, shape (actions, values, values)
+        Z            array-like, shape (actions, values, observations)
+        R            array-like, shape (actions, values), default zeros
+
+        Values and observations are joined with '_' to name joint
+        states and written to .pomdp files, so they may not contain
+        '_', ':', '*', or whitespace.
+        """
+        self.name = name
+        self.values = list(values)
+        self.observations = list(observations)
+        for label in self.values + self.observations:
+            if (not label or len(label.split()) != 1 or
+                    any(c in label for c in '_:*')):
+                raise Exception(
+                    "Bad value or observation name %r for variable %s" %
+                    (label, name))
+        self.T = np.asarray(T, dtype=float)
+        self.Z = np.asarray(Z, dtype=float)
+        if R is None:
+            R = np.zeros((self.T.shape[0], len(self.values)))
+        self.R = np.asarray(R, dtype=float)
+
+
+class FactoredPOMDPEnvironment:
+    """
+    A POMDP whose state is the Cartesian product of independent
+    StateVariables. Joint states and observations are numbered in
+    C order over the variables (the last variable changes fastest), so
+    beliefs are the same (S, 1) column vectors POMDPEnvironment uses and
+    work with POMDPPolicy as-is.
+
+    Belief updates and expected rewards contract the belief tensor with
+    each variable's tables in turn; the joint T, Z, and R are never
+    built except by to_pomdp.
+
+    Attributes:
+        discount
+        values
+        variables      list of StateVariable
+        shape          tuple, number of values of each variable
+        obs_shape      tuple, number of observations of each variable
+        states         list of joint state names
+        actions
+        observations   list of joint observation names
+    """
+
+    def __init__(self, variables, actions, discount=0.95):
+        """
+        variables list of StateVariable
+        actions   list of strings
+        discount  float
+        """
+        self.discount = discount
+        self.values = 'reward'
+        self.variables = list(variables)
+        self.actions = list(actions)
+        n_actions = len(self.actions)
+        for var in self.variables:
+            n_values = len(var.values)
+            n_obs = len(var.observations)
+            if var.T.shape != (n_actions, n_values, n_values):
+                raise Exception("Bad T shape for variable " + var.name)
+            if var.Z.shape != (n_actions, n_values, n_obs):
+                raise Exception("Bad Z shape for variable " + var.name)
+            if var.R.shape != (n_actions, n_values):
+                raise Exception("Bad R shape for variable " + var.name)
+        self.shape = tuple(len(var.values) for var in self.variables)
+        self.obs_shape = tuple(
+            len(var.observations) for var in self.variables)
+        self.states = [
+            '_'.join(vals) for vals in
+            itertools.product(*[var.values for var in self.variables])
+        ]
+        self.observations = [
+            '_'.join(obs) for obs in
+            itertools.product(*[var.observations for var in self.variables])
+        ]
+
+    def update_belief(self, prev_belief, action_num, observation_num):
+        """
+        Same contract as POMDPEnvironment.update_belief. observation_num
+        indexes the joint observations.
+
+        prev_belief     numpy array
+        action_num      int
+        observation_num int
+        return          numpy array
+        """
+        obs = np.unravel_index(observation_num, self.obs_shape)
+        b = np.asarray(prev_belief, dtype=float).reshape(self.shape)
+        for i, var in enumerate(self.variables):
+            # Contracting the leading axis appends the new one at the
+            # end, so after every variable the axes are back in order.
+            b = np.tensordot(b, var.T[action_num], axes=([0], [0]))
+            b = b * var.Z[action_num, :, obs[i]]
+        b_new = b.reshape((-1, 1))
+        total = b_new.sum()
+        if total == 0.0:
+            raise Exception(
+                "Observation %s is impossible after action %s from this "
+                "belief" % (self.observations[observation_num],
+                            self.actions[action_num]))
+        return b_new / total
+
+    def expected_reward(self, belief, action_num):
+        """
+        Expected immediate reward of taking action_num in belief.
+
+        belief     numpy array
+        action_num int
+        return     float
+        """
+        b = np.asarray(belief, dtype=float).reshape(self.shape)
+        axes = range(len(self.variables))
+        total = 0.0
+        for i, var in enumerate(self.variables):
+            marginal = b.sum(axis=tuple(a for a in axes if a != i))
+            total += marginal.dot(var.R[action_num])
+        return total
+
+    def to_pomdp(self, filename):
+        """
+        Writes the flattened joint model as a .pomdp file that
+        POMDPEnvironment can load. Builds S x S matrices, so only use
+        this on small models (e.g. to verify against the flat code).
+
+        filename string
+        """
+        f = open(filename, 'w')
+        f.write('discount: %r\n' % (float(self.discount),))
+        f.write('values: %s\n' % (self.values,))
+        f.write('states: %s\n' % (' '.join(self.states),))
+        f.write('actions: %s\n' % (' '.join(self.actions),))
+        f.write('observations: %s\n' % (' '.join(self.observations),))
+        for a, action in enumerate(self.actions):
+            T = np.ones((1, 1))
+            Z = np.ones((1, 1))
+            for var in self.variables:
+                T = np.kron(T, var.T[a])
+                Z = np.kron(Z, var.Z[a])
+            f.write('\nT: %s\n' % (action,))
+            for row in T:
+                f.write(' '.join(repr(float(p)) for p in row) + '\n')
+            f.write('\nO: %s\n' % (action,))
+            for row in Z:
+                f.write(' '.join(repr(float(p)) for p in row) + '\n')
+            f.write('\n')
+            rewards = np.zeros(self.shape)
+            for i, var in enumerate(self.variables):
+                index = [np.newaxis] * len(self.variables)
+                index[i] = slice(None)
+                rewards = rewards + var.R[a][tuple(index)]
+            for state, r in zip(self.states, rewards.flatten()):
+                f.write('R: %s : %s : * : * %r\n' % (action, state, float(r)))
+        f.close()
+
+
 class POMDPPolicy:
     """
     Attributes:
@@ -474,9 +969,12 @@ class POMDPPolicy:
 
         pMatrix        The policy matrix, constructed from all of the
                        alpha vectors.
+
+        filename       The policy file this was loaded from.
     """
 
     def __init__(self, filename):
+        self.filename = filename
         tree = ET.parse(filename)
         root = tree.getroot()
         avec = list(root)[0]
@@ -501,6 +999,201 @@ class POMDPPolicy:
         best_action = self.action_nums[res.argmax()]
         return (best_action, highest_expected_reward)
 
+    def check(self, num_states=None):
+        """
+        Raises unless the policy has at least one alpha vector, all of
+        the same length (num_states, if given) and all finite.
+
+        num_states int
+        """
+        if len(self.action_nums) == 0:
+            raise Exception("No alpha vectors in policy file " +
+                            self.filename)
+        if self.pMatrix.ndim != 2:
+            raise Exception("Alpha vectors have mismatched lengths in " +
+                            self.filename)
+        if not np.isfinite(self.pMatrix).all():
+            raise Exception("Non-finite alpha vector values in " +
+                            self.filename)
+        length = self.pMatrix.shape[1]
+        if num_states is not None and length != num_states:
+            raise Exception(
+                "Expected alpha vectors of length %d, got %d in %s" %
+                (num_states, length, self.filename))
+
+
+class ReloadablePolicy:
+    """
+    Handle around a POMDPPolicy whose alpha vectors can be replaced by a
+    retrained policy file while other threads keep calling
+    get_best_action.
+
+    A reload parses and checks the new file completely before swapping
+    it in with a single attribute assignment, so readers never take a
+    lock and never see a half-loaded policy. Callers that already hold
+    the old POMDPPolicy keep using it until they drop their reference.
+
+    Attributes:
+        filename       Policy file that reload() reads by default.
+
+        num_states     Expected alpha vector length, or None to only
+                       require that it matches the current policy.
+
+        policy         The POMDPPolicy currently being served.
+
+        version        Number of successful swaps since construction.
+
+        last_error     Exception raised by the most recent failed
+                       background reload, or None.
+    """
+
+    def __init__(self, filename, num_states=None):
+        """
+        filename   string
+        num_states int
+        """
+        self.filename = filename
+        self.num_states = num_states
+        self.policy = self.__load(filename)
+        self.version = 0
+        self.last_error = None
+        # Serializes reloads against each other; readers never take it.
+        self.__reload_lock = threading.Lock()
+        self.__watcher = None
+        self.__stop = threading.Event()
+
+    def get_best_action(self, belief):
+        """
+        Returns tuple:
+            (best-action-num, expected-reward-for-this-action).
+        """
+        # Read the reference once so a concurrent swap can't mix the old
+        # and new alpha vectors within a single call.
+        policy = self.policy
+        return policy.get_best_action(belief)
+
+    def reload(self, filename=None):
+        """
+        Parses filename (default: self.filename) and swaps it in as the
+        served policy. Raises and keeps the current policy if the new
+        file can't be parsed or doesn't fit.
+
+        filename string
+        return   int, the new version
+        """
+        if filename is None:
+            filename = self.filename
+        with self.__reload_lock:
+            policy = self.__load(filename)
+            self.filename = filename
+            self.policy = policy
+            self.version += 1
+            return self.version
+
+    def reload_async(self, filename=None):
+        """
+        Runs reload() on a background thread. Failures are stored in
+        last_error instead of being raised.
+
+        filename string
+        return   threading.Thread
+        """
+        thread = threading.Thread(target=self.__try_reload, args=(filename,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def watch(self, interval=1.0, retries=5):
+        """
+        Starts a background thread that polls the policy file every
+        interval seconds and reloads it whenever its mtime or size
+        changes.
+
+        A version of the file that fails to load is retried up to
+        retries more times, waiting twice as many ticks before each
+        retry, and then left alone until the file changes again.
+
+        interval float
+        retries  int
+        """
+        if self.__watcher is not None:
+            return
+        self.__stop.clear()
+        # Stamp the file now so a change made right after watch()
+        # returns isn't mistaken for the starting state.
+        self.__watcher = threading.Thread(
+            target=self.__watch_loop,
+            args=(interval, retries, self.__stamp()))
+        self.__watcher.daemon = True
+        self.__watcher.start()
+
+    def stop(self):
+        """
+        Stops the thread started by watch(), if any.
+        """
+        if self.__watcher is None:
+            return
+        self.__stop.set()
+        self.__watcher.join()
+        self.__watcher = None
+
+    def __try_reload(self, filename):
+        try:
+            self.reload(filename)
+            self.last_error = None
+            return True
+        except Exception as e:
+            self.last_error = e
+            return False
+
+    def __watch_loop(self, interval, retries, last_stamp):
+        failed_stamp = None
+        failures = 0
+        skip = 0
+        while not self.__stop.wait(interval):
+            stamp = self.__stamp()
+            if stamp is None:
+                # File is probably being replaced; try again next tick.
+                continue
+            if stamp == last_stamp:
+                continue
+            if stamp != failed_stamp:
+                failed_stamp = stamp
+                failures = 0
+                skip = 0
+            elif skip > 0:
+                skip -= 1
+                continue
+            elif failures > retries:
+                continue
+            # Only remember the stamp once it loads, so a half-written
+            # file is retried even if the rest lands in the same mtime.
+            if self.__try_reload(None):
+                last_stamp = stamp
+                failed_stamp = None
+            else:
+                failures += 1
+                skip = 2 ** failures - 1
+
+    def __stamp(self):
+        """
+        Returns (mtime, size) of the policy file, or None if it can't
+        be read right now.
+        """
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def __load(self, filename):
+        policy = POMDPPolicy(filename)
+        expected = self.num_states
+        if expected is None and getattr(self, 'policy', None) is not None:
+            expected = self.policy.pMatrix.shape[1]
+        policy.check(expected)
+        return policy
+
 
 def is_numeric(lst):
     if len(lst) == 1:
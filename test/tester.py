@@ -6,7 +6,10 @@ author: mbforbes
 
 # builtins
 import os
+import shutil
 import sys
+import tempfile
+import time
 import unittest
 
 # 3rd party
@@ -231,5 +234,507 @@ class POMDPEndToEndTest(unittest.TestCase):
         # Re-enable printing.
         sys.stdout = sys.__stdout__
 
+
+class ReloadablePolicyTest(unittest.TestCase):
+    """Tests swapping a policy in place with ReloadablePolicy."""
+
+    def setUp(self):
+        """Copy the voicemail policy somewhere we can overwrite it."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.policyfile = os.path.join(self.tmpdir, 'voicemail.policy')
+        shutil.copy('examples/policy/voicemail.policy', self.policyfile)
+        self.policy = pomdp.ReloadablePolicy(self.policyfile, 2)
+        self.belief = np.array([[0.65], [0.35]])
+
+    def tearDown(self):
+        self.policy.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def write_policy(self, vectors):
+        """Overwrites the policy file with the given (action, values)
+        alpha vectors.
+        """
+        lines = ['<Policy><AlphaVector>']
+        for action, vals in vectors:
+            lines.append('<Vector action="%d">%s</Vector>' % (
+                action, ' '.join(str(v) for v in vals)))
+        lines.append('</AlphaVector></Policy>')
+        with open(self.policyfile, 'w') as f:
+            f.write('\n'.join(lines))
+
+    def test_reload(self):
+        """A reload swaps in the new alpha vectors and bumps the
+        version.
+        """
+        self.assertEqual(self.policy.get_best_action(self.belief)[0], 0)
+        self.write_policy([(0, [0.0, 0.0]), (1, [10.0, 10.0])])
+        self.assertEqual(self.policy.reload(), 1)
+        best_action, reward = self.policy.get_best_action(self.belief)
+        self.assertEqual(best_action, 1)
+        self.assertEqual(reward, 10.0)
+
+    def test_bad_reload_keeps_old_policy(self):
+        """Vectors of the wrong length are rejected and the old policy
+        keeps serving.
+        """
+        old = self.policy.policy
+        self.write_policy([(1, [10.0, 10.0, 10.0])])
+        self.assertRaises(Exception, self.policy.reload)
+        self.assertIs(self.policy.policy, old)
+        self.assertEqual(self.policy.version, 0)
+
+        # Background reloads record the error instead of raising.
+        self.policy.reload_async().join()
+        self.assertIsNotNone(self.policy.last_error)
+        self.assertIs(self.policy.policy, old)
+
+    def test_reload_async(self):
+        """A background reload swaps the policy once it finishes."""
+        self.write_policy([(2, [10.0, 10.0])])
+        self.policy.reload_async().join()
+        self.assertIsNone(self.policy.last_error)
+        self.assertEqual(self.policy.version, 1)
+        self.assertEqual(self.policy.get_best_action(self.belief)[0], 2)
+
+    def test_watch(self):
+        """The watcher reloads the policy once the file changes."""
+        self.policy.watch(interval=0.01)
+        self.write_policy([(1, [10.0, 10.0])])
+        for _ in range(500):
+            if self.policy.version > 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.policy.version, 1)
+        self.assertEqual(self.policy.get_best_action(self.belief)[0], 1)
+
+    def test_watch_retries_bad_file(self):
+        """A file that fails to load is retried on later ticks even if
+        its mtime and size don't change again.
+        """
+        self.policy.watch(interval=0.01)
+        self.write_policy([(1, ['10.0', 'bad!'])])
+        os.utime(self.policyfile, (1000000000, 1000000000))
+        for _ in range(500):
+            if self.policy.last_error is not None:
+                break
+            time.sleep(0.01)
+        self.assertIsNotNone(self.policy.last_error)
+        self.assertEqual(self.policy.version, 0)
+
+        # Same size and mtime as the bad file.
+        self.write_policy([(1, ['10.0', '10.0'])])
+        os.utime(self.policyfile, (1000000000, 1000000000))
+        for _ in range(500):
+            if self.policy.version > 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.policy.version, 1)
+        self.assertIsNone(self.policy.last_error)
+
+    def test_watch_gives_up_on_bad_file(self):
+        """A file that keeps failing is only retried a few times."""
+        loads = []
+        real_policy = pomdp.POMDPPolicy
+
+        def counting_policy(filename):
+            loads.append(filename)
+            return real_policy(filename)
+
+        pomdp.POMDPPolicy = counting_policy
+        try:
+            self.policy.watch(interval=0.005, retries=2)
+            self.write_policy([(1, [10.0, 10.0, 10.0])])
+            time.sleep(0.5)
+        finally:
+            self.policy.stop()
+            pomdp.POMDPPolicy = real_policy
+        self.assertEqual(len(loads), 3)
+        self.assertEqual(self.policy.version, 0)
+
+    def test_full_pomdp(self):
+        """A reloadable POMDP gives the same answers as a plain one."""
+        mypomdp = pomdp.POMDP(
+            'examples/env/voicemail.pomdp', self.policyfile, self.belief,
+            reloadable=True)
+        best_action, reward = mypomdp.get_best_action()
+        self.assertEqual(mypomdp.get_action_str(best_action), 'ask')
+        self.assertAlmostEqual(reward, 3.46, places=2)
+
+
+class FactoredPOMDPTest(unittest.TestCase):
+    """Tests the factored environment against its flattened .pomdp
+    version.
+    """
+
+    def setUp(self):
+        """Build a two-variable model and load its flattened version."""
+        # Two slots; 'ask' keeps them, 'reset' resamples them.
+        color = pomdp.StateVariable(
+            'color', ['red', 'blue'], ['hearRed', 'hearBlue'],
+            [[[1.0, 0.0], [0.0, 1.0]], [[0.5, 0.5], [0.5, 0.5]]],
+            [[[0.8, 0.2], [0.3, 0.7]], [[0.5, 0.5], [0.5, 0.5]]],
+            [[-1.0, -1.0], [2.0, -3.0]])
+        size = pomdp.StateVariable(
+            'size', ['small', 'medium', 'large'], ['hearSmall', 'hearLarge'],
+            [[[0.9, 0.1, 0.0], [0.05, 0.9, 0.05], [0.0, 0.1, 0.9]],
+             [[0.2, 0.6, 0.2], [0.2, 0.6, 0.2], [0.2, 0.6, 0.2]]],
+            [[[0.9, 0.1], [0.5, 0.5], [0.1, 0.9]],
+             [[0.5, 0.5], [0.5, 0.5], [0.5, 0.5]]],
+            [[0.0, 0.0, 0.0], [1.0, 0.0, -1.0]])
+        self.factored = pomdp.FactoredPOMDPEnvironment(
+            [color, size], ['ask', 'reset'])
+
+        self.tmpdir = tempfile.mkdtemp()
+        pomdpfile = os.path.join(self.tmpdir, 'factored.pomdp')
+        self.factored.to_pomdp(pomdpfile)
+        self.flat = pomdp.POMDPEnvironment(pomdpfile)
+
+        self.belief = np.array(
+            [[0.1], [0.2], [0.1], [0.3], [0.2], [0.1]])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_flatten(self):
+        """The flattened model has the joint states and observations."""
+        self.assertEqual(self.flat.states, self.factored.states)
+        self.assertEqual(self.flat.observations, self.factored.observations)
+        self.assertEqual(self.flat.states[1], 'red_medium')
+        self.assertEqual(self.flat.observations[3], 'hearBlue_hearLarge')
+        self.assertAlmostEqual(self.flat.T[(0, 1, 2)], 0.05)
+        self.assertAlmostEqual(self.flat.Z[(0, 0, 3)], 0.2 * 0.1)
+
+    def test_belief_updates(self):
+        """Factored belief updates match the flat ones."""
+        for a in range(len(self.factored.actions)):
+            for o in range(len(self.factored.observations)):
+                expected = self.flat.update_belief(self.belief, a, o)
+                actual = self.factored.update_belief(self.belief, a, o)
+                self.assertEqual(actual.shape, (6, 1))
+                self.assertTrue(np.allclose(actual, expected))
+
+    def test_impossible_observation(self):
+        """Updating on an unreachable observation raises like the flat
+        environment does.
+        """
+        # Make hearLarge impossible after ask.
+        self.factored.variables[1].Z[0, :, 1] = 0.0
+        self.assertRaises(
+            Exception, self.factored.update_belief, self.belief, 0, 1)
+
+    def test_bad_names(self):
+        """Names that could collide once joined are rejected."""
+        T = [[[1.0, 0.0], [0.0, 1.0]]]
+        Z = [[[1.0], [1.0]]]
+        for values in (['a_b', 'c'], ['a b', 'c'], ['a:', 'c'], ['*', 'c']):
+            self.assertRaises(
+                Exception, pomdp.StateVariable, 'x', values, ['o'], T, Z)
+
+    def test_single_variable(self):
+        """A one-variable model round-trips through to_pomdp."""
+        var = pomdp.StateVariable(
+            'door', ['left', 'right'], ['hearLeft', 'hearRight'],
+            [[[1.0, 0.0], [0.0, 1.0]]],
+            [[[0.85, 0.15], [0.15, 0.85]]],
+            [[-1.0, 2.0]])
+        factored = pomdp.FactoredPOMDPEnvironment([var], ['listen'])
+        pomdpfile = os.path.join(self.tmpdir, 'single.pomdp')
+        factored.to_pomdp(pomdpfile)
+        flat = pomdp.POMDPEnvironment(pomdpfile)
+        self.assertEqual(flat.states, ['left', 'right'])
+        self.assertEqual(flat.observations, ['hearLeft', 'hearRight'])
+
+        belief = np.array([[0.3], [0.7]])
+        for o in range(2):
+            self.assertTrue(np.allclose(
+                factored.update_belief(belief, 0, o),
+                flat.update_belief(belief, 0, o)))
+        self.assertAlmostEqual(
+            factored.expected_reward(belief, 0),
+            flat.expected_reward(belief, 0))
+
+    def test_expected_reward(self):
+        """Factored expected rewards match the flattened R."""
+        for a in range(len(self.factored.actions)):
+            expected = sum(
+                self.belief[s, 0] * self.flat.R[(a, s, 0, 0)]
+                for s in range(len(self.flat.states)))
+            self.assertAlmostEqual(
+                self.factored.expected_reward(self.belief, a), expected)
+
+
+class POMDPEditTest(unittest.TestCase):
+    """Tests editing a loaded POMDP Environment."""
+
+    def setUp(self):
+        """Load the voicemail environment and warm its caches."""
+        self.env = pomdp.POMDPEnvironment('examples/env/voicemail.pomdp')
+        self.belief = np.array([[0.65], [0.35]])
+        for a in range(len(self.env.actions)):
+            self.env.expected_reward(self.belief, a)
+
+    def test_expected_reward(self):
+        """Expected rewards come from R averaged over T and Z."""
+        self.assertAlmostEqual(self.env.expected_reward(self.belief, 0), -1)
+        self.assertAlmostEqual(
+            self.env.expected_reward(self.belief, 1), 0.65 * 5 - 0.35 * 10)
+
+    def test_set_observation_row(self):
+        """Editing Z for one action updates beliefs for it and leaves
+        the other actions' matrices alone.
+        """
+        other = self.env.get_observation_matrix(1)
+        self.env.set_observation_row(0, 0, [2.0, 2.0], normalize=True)
+        self.assertEqual(self.env.version, 1)
+        self.assertEqual(self.env.Z[(0, 0, 0)], 0.5)
+        self.assertEqual(self.env.get_observation_matrix(0)[0, 1], 0.5)
+        self.assertTrue((self.env.get_observation_matrix(1) == other).all())
+
+        # hearSave is now 0.5 vs 0.3 likely
+        belief = self.env.update_belief(self.belief, 0, 0)
+        expected = np.array([[0.65 * 0.5], [0.35 * 0.3]])
+        self.assertTrue(np.allclose(belief, expected / expected.sum()))
+
+    def test_set_transition(self):
+        """Editing one T entry with normalize rescales the rest of its
+        row and refreshes expected rewards.
+        """
+        self.env.set_transition(1, 0, 0, 0.8, normalize=True)
+        self.assertEqual(self.env.version, 1)
+        self.assertAlmostEqual(self.env.T[(1, 0, 1)], 0.2)
+        self.assertAlmostEqual(
+            self.env.get_transition_matrix(1)[0, 1], 0.2)
+        # R doesn't depend on next state here, so rewards are unchanged.
+        self.assertAlmostEqual(
+            self.env.expected_reward(self.belief, 1), 0.65 * 5 - 0.35 * 10)
+
+        self.env.set_transition_row(1, 1, [0.0, 0.0])
+        self.assertAlmostEqual(self.env.expected_reward(self.belief, 1),
+                               0.65 * 5)
+        self.assertRaises(
+            Exception, self.env.set_transition_row, 1, 1, [0.0, 0.0],
+            normalize=True)
+
+    def test_failed_normalize_changes_nothing(self):
+        """An edit whose row can't be normalized leaves the dicts,
+        caches, and version as they were.
+        """
+        # ask is identity, so the rest of the row has no mass.
+        self.assertRaises(
+            Exception, self.env.set_transition, 0, 0, 0, 0.8,
+            normalize=True)
+        self.assertEqual(self.env.T[(0, 0, 0)], 1.0)
+        self.assertEqual(self.env.get_transition_matrix(0)[0, 0], 1.0)
+        self.assertEqual(self.env.version, 0)
+
+    def test_bad_edits(self):
+        """Edits with bad indices or probabilities raise without
+        changing anything.
+        """
+        T = dict(self.env.T)
+        Z = dict(self.env.Z)
+        bad_edits = [
+            (self.env.set_transition_row, (1, 5, [0.2, 0.8])),
+            (self.env.set_transition_row, (1, -1, [0.2, 0.8])),
+            (self.env.set_transition, (7, 0, 0, 0.3)),
+            (self.env.set_transition, (None, 0, 0, 0.3)),
+            (self.env.set_transition, (1, 0, 0, 1.5)),
+            (self.env.set_transition, (1, 0, 0, float('nan'))),
+            (self.env.set_transition_row, (1, 0, [1.5, -0.5])),
+            (self.env.set_observation, (0, 0, 2, 0.3)),
+            (self.env.set_observation_row, (3, 0, [0.5, 0.5])),
+            (self.env.set_observation_row, (0, 0, [float('inf'), 0.0])),
+        ]
+        for method, args in bad_edits:
+            self.assertRaises(Exception, method, *args)
+        self.assertEqual(self.env.T, T)
+        self.assertEqual(self.env.Z, Z)
+        self.assertEqual(self.env.version, 0)
+        self.assertEqual(self.env.get_transition_matrix(1)[1, 0], 0.65)
+
+    def test_normalize_fixed_one(self):
+        """Fixing an entry at 1.0 zeroes the rest of the row, even if
+        it had no other mass.
+        """
+        self.env.set_transition(0, 0, 0, 1.0, normalize=True)
+        self.assertEqual(self.env.T[(0, 0, 1)], 0.0)
+        self.env.set_transition(1, 0, 1, 1.0, normalize=True)
+        self.assertEqual(self.env.T[(1, 0, 0)], 0.0)
+        self.assertEqual(self.env.get_transition_matrix(1)[0, 1], 1.0)
+
+    def test_normalize_wildcard_observation(self):
+        """Normalizing an action's Z row starts from the * entries it
+        inherits.
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            pomdpfile = os.path.join(tmpdir, 'wildcard.pomdp')
+            with open(pomdpfile, 'w') as f:
+                f.write('\n'.join([
+                    'discount: 0.95',
+                    'values: reward',
+                    'states: a b',
+                    'actions: stay move',
+                    'observations: hearA hearB',
+                    'T: stay',
+                    'identity',
+                    'T: move',
+                    'uniform',
+                    'O: *',
+                    '0.9 0.1',
+                    '0.3 0.7',
+                    'R: * : * : * : * 0',
+                ]))
+            env = pomdp.POMDPEnvironment(pomdpfile)
+            env.get_observation_matrix(0)
+            env.set_observation(0, 0, 0, 0.5, normalize=True)
+            self.assertEqual(env.Z[(0, 0, 1)], 0.5)
+            self.assertTrue(
+                (env.get_observation_matrix(0)[0] == [0.5, 0.5]).all())
+            # The other action still uses the * row.
+            self.assertTrue(
+                (env.get_observation_matrix(1)[0] == [0.9, 0.1]).all())
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class POMDPCheckTest(unittest.TestCase):
+    """Tests the model checks run when loading an environment."""
+
+    def setUp(self):
+        """Write an environment with a few bad rows."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.pomdpfile = os.path.join(self.tmpdir, 'bad.pomdp')
+        with open(self.pomdpfile, 'w') as f:
+            f.write('\n'.join([
+                'discount: 0.95',
+                'values: reward',
+                'states: a b',
+                'actions: stay move',
+                'observations: hearA hearB hearNothing',
+                'T: stay',
+                'identity',
+                'T: move',
+                '0.5 0.7',
+                '0.0 0.0',
+                'O: *',
+                '0.9 0.1 0.0',
+                '0.3 0.3 0.0',
+                'R: * : * : * : * 0',
+            ]))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_reports_bad_rows(self):
+        """Loading raises; check_model lists every bad row."""
+        self.assertRaises(
+            Exception, pomdp.POMDPEnvironment, self.pomdpfile)
+        env = pomdp.POMDPEnvironment(self.pomdpfile, check=False)
+        bad_rows = env.check_model()
+        self.assertEqual(len(bad_rows), 4)
+        self.assertEqual(bad_rows[0], ('T', 1, 0, 1.2))
+        self.assertEqual(bad_rows[1], ('T', 1, 1, 0.0))
+        self.assertEqual(bad_rows[2][:3], ('Z', 0, 1))
+        self.assertAlmostEqual(bad_rows[2][3], 0.6)
+        self.assertEqual(bad_rows[3][:3], ('Z', 1, 1))
+        self.assertTrue(
+            (env.unreachable_observations == [[0, 0, 1], [0, 0, 1]]).all())
+
+    def test_normalize(self):
+        """Normalizing fixes rows with mass; empty rows still raise."""
+        self.assertRaises(
+            Exception, pomdp.POMDPEnvironment, self.pomdpfile,
+            normalize=True)
+        env = pomdp.POMDPEnvironment(self.pomdpfile, check=False)
+        env.check_model(normalize=True)
+        self.assertAlmostEqual(env.T[(1, 0, 0)], 0.5 / 1.2)
+        # The * row is overridden per action.
+        self.assertAlmostEqual(env.Z[(0, 1, 0)], 0.5)
+        self.assertAlmostEqual(env.Z[(1, 1, 0)], 0.5)
+        remaining = env.check_model()
+        self.assertEqual(remaining, [('T', 1, 1, 0.0)])
+
+    def test_negative_and_nan_rows(self):
+        """Rows with negative or NaN entries are reported even when
+        they sum to 1.0, and normalizing doesn't hide them.
+        """
+        with open(self.pomdpfile, 'w') as f:
+            f.write('\n'.join([
+                'discount: 0.95',
+                'values: reward',
+                'states: a b',
+                'actions: move',
+                'observations: hearA hearB',
+                'T: move',
+                '1.5 -0.5',
+                '0.5 0.5',
+                'O: *',
+                'nan nan',
+                '0.5 0.5',
+                'R: * : * : * : * 0',
+            ]))
+        self.assertRaises(
+            Exception, pomdp.POMDPEnvironment, self.pomdpfile,
+            normalize=True)
+        env = pomdp.POMDPEnvironment(self.pomdpfile, check=False)
+        bad_rows = env.check_model(normalize=True)
+        self.assertEqual(len(bad_rows), 2)
+        self.assertEqual(bad_rows[0], ('T', 0, 0, 1.0))
+        self.assertEqual(bad_rows[1][:3], ('Z', 0, 0))
+        self.assertTrue(np.isnan(bad_rows[1][3]))
+        self.assertEqual(env.T[(0, 0, 1)], -0.5)
+
+    def test_unreachable_after_edit(self):
+        """Observation edits keep the unreachable mask current."""
+        env = pomdp.POMDPEnvironment(self.pomdpfile, check=False)
+        env.check_model()
+        self.assertTrue(env.unreachable_observations[0, 2])
+        env.set_observation_row(0, 0, [0.4, 0.3, 0.3])
+        self.assertFalse(env.unreachable_observations[0, 2])
+        self.assertTrue(env.unreachable_observations[1, 2])
+        env.set_observation_row(None, 1, [0.0, 0.0, 1.0])
+        self.assertFalse(env.unreachable_observations[1, 2])
+        self.assertFalse(env.unreachable_observations[1, 1])
+
+    def test_impossible_observation(self):
+        """Updating on an unreachable observation raises instead of
+        returning NaNs.
+        """
+        env = pomdp.POMDPEnvironment(self.pomdpfile, check=False)
+        self.assertRaises(
+            Exception, env.update_belief, np.array([[0.5], [0.5]]), 0, 2)
+
+    def test_policy_length(self):
+        """A policy for a different number of states is rejected."""
+        self.assertRaises(
+            Exception, pomdp.POMDP, 'examples/env/env_parser_test.pomdp',
+            'examples/policy/voicemail.policy', np.array([[1.0], [0], [0]]))
+
+    def test_ragged_policy(self):
+        """A policy whose vectors have different lengths is rejected,
+        even when there are as many vectors as states.
+        """
+        policyfile = os.path.join(self.tmpdir, 'ragged.policy')
+        with open(policyfile, 'w') as f:
+            f.write('<Policy><AlphaVector>'
+                    '<Vector action="0">1.0 2.0</Vector>'
+                    '<Vector action="1">1.0 2.0 3.0</Vector>'
+                    '</AlphaVector></Policy>')
+        self.assertRaises(
+            Exception, pomdp.POMDP, 'examples/env/voicemail.pomdp',
+            policyfile, np.array([[0.65], [0.35]]))
+
+    def test_normalize_bumps_version_once(self):
+        """Normalizing several rows is one edit."""
+        env = pomdp.POMDPEnvironment(self.pomdpfile, check=False)
+        env.check_model(normalize=True)
+        self.assertEqual(env.version, 1)
+        self.assertTrue(
+            np.allclose(env.get_transition_matrix(1)[0], [0.5 / 1.2,
+                                                          0.7 / 1.2]))
+        self.assertEqual(env.check_model(), [('T', 1, 1, 0.0)])
+        self.assertEqual(env.version, 1)
+
 if __name__ == '__main__':
     unittest.main()